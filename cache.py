@@ -0,0 +1,95 @@
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+from binaryninja import user_directory
+
+# Bump whenever the decoder, the region classifier or the layout below changes so stale
+# entries written by an older plugin are never loaded
+CACHE_VERSION = 4
+
+MAGIC = b"E0C6"
+HEADER = struct.Struct("<4sHI")
+
+###########################################
+# Cache file layout (little endian)       #
+#-----------------------------------------#
+# magic   | 4 bytes  | b"E0C6"            #
+# version | u16      | CACHE_VERSION      #
+# count   | u32      | number of PSETs    #
+# entries | 2*count  | u32 addr, u32 word #
+###########################################
+
+def cache_dir() -> str:
+    return os.path.join(user_directory(), "e0c6s46_cache")
+
+def rom_key(rom:bytes) -> str:
+    '''
+    Cache key for a ROM: content hash salted with the cache version
+    '''
+    h = hashlib.sha256(rom)
+    h.update(CACHE_VERSION.to_bytes(2, "little"))
+    return h.hexdigest()
+
+def bank_key(data:bytes, bank:int) -> str:
+    '''
+    Cache key for one bank of a ROM, so each bank is cached and loaded on its own
+    '''
+    return rom_key(bank.to_bytes(2, "little") + data)
+
+def _path(key:str) -> str:
+    return os.path.join(cache_dir(), f"{key}.psets")
+
+def load(key:str):
+    '''
+    Returns the cached list of (addr, 12 bit PSET word) pairs for key or None on a miss
+    '''
+    try:
+        with open(_path(key), "rb") as f:
+            raw = f.read()
+    except OSError:
+        return None
+
+    if len(raw) < HEADER.size:
+        return None
+
+    magic, version, count = HEADER.unpack_from(raw)
+    if magic != MAGIC or version != CACHE_VERSION or len(raw) != HEADER.size + 8 * count:
+        return None
+
+    entries = array("I")
+    entries.frombytes(raw[HEADER.size:])
+    if sys.byteorder == "big":
+        entries.byteswap()
+
+    return list(zip(entries[0::2], entries[1::2]))
+
+def store(key:str, psets):
+    '''
+    Writes the (addr, 12 bit PSET word) pairs for key. Failures are not fatal,
+    the ROM simply gets swept again next time
+    '''
+    # Addresses go past 16 bits on ROMs over 64 KiB
+    entries = array("I")
+    for addr, word in psets:
+        entries.append(addr)
+        entries.append(word)
+    if sys.byteorder == "big":
+        entries.byteswap()
+
+    path = _path(key)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, CACHE_VERSION, len(psets)))
+            f.write(entries.tobytes())
+        # Atomic so a concurrent load never sees a partial file
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
@@ -0,0 +1,125 @@
+from functools import lru_cache
+
+import numpy as np
+
+from .disassembler import Instruction, PSetFinder, IMM, ADDR, BANK_SIZE
+
+# Values of the target_kind lookup table
+NO_TARGET = 0
+PAGE_JUMP = 1   # JP and JP cc: page from PSET | s
+PAGE_CALL = 2   # CALL: bank of PC | page from PSET | s
+ZERO_CALL = 3   # CALZ: bank of PC | page 0 | s
+
+ROM_DTYPE = np.dtype([
+    ("addr", np.uint32),
+    ("word", np.uint16),
+    ("mnemonic", np.uint8),
+    ("op1_kind", np.int8),
+    ("op1_value", np.int16),
+    ("op2_kind", np.int8),
+    ("op2_value", np.int16),
+    ("branch", np.int8),
+    ("target", np.int32),
+])
+
+class Tables:
+    '''
+    Lookup tables for every possible 12 bit word, decoded once by Instruction.parse
+
+    mnemonic ids index into self.mnemonics, register and condition operands
+    (STR, REG, REG_DEREF) store an index into self.names as their value
+    '''
+    def __init__(self):
+        self.mnemonics = []
+        self.names = []
+        mnemonic_ids = {}
+        name_ids = {}
+
+        self.mnemonic = np.zeros(4096, np.uint8)
+        self.op_kind = np.full((2, 4096), -1, np.int8)
+        self.op_value = np.zeros((2, 4096), np.int16)
+        self.branch = np.full(4096, -1, np.int8)
+        self.target_kind = np.zeros(4096, np.uint8)
+
+        for word in range(4096):
+            instr = Instruction(word.to_bytes(2, "big"), 0)
+
+            if instr.mnemonic not in mnemonic_ids:
+                mnemonic_ids[instr.mnemonic] = len(self.mnemonics)
+                self.mnemonics.append(instr.mnemonic)
+            self.mnemonic[word] = mnemonic_ids[instr.mnemonic]
+
+            for i, op in enumerate((instr.op1, instr.op2)):
+                if op is None:
+                    continue
+                value, kind = op
+                if kind not in (IMM, ADDR):
+                    if value not in name_ids:
+                        name_ids[value] = len(self.names)
+                        self.names.append(value)
+                    value = name_ids[value]
+                self.op_kind[i, word] = kind
+                self.op_value[i, word] = value
+
+            if instr.branches:
+                self.branch[word] = instr.branches[0]._type
+                if instr.branches[0].target is not None:
+                    if instr.mnemonic == "JP":
+                        self.target_kind[word] = PAGE_JUMP
+                    elif instr.mnemonic == "CALL":
+                        self.target_kind[word] = PAGE_CALL
+                    elif instr.mnemonic == "CALZ":
+                        self.target_kind[word] = ZERO_CALL
+
+        self.pset_id = mnemonic_ids["PSET"]
+
+@lru_cache()
+def tables() -> Tables:
+    return Tables()
+
+def rom_array(data:bytes) -> np.ndarray:
+    '''
+    Raw ROM bytes as an array of 12 bit words
+    '''
+    raw = np.frombuffer(data, dtype=">u2", count=len(data) // 2)
+    return (raw & 0xFFF).astype(np.uint16)
+
+def decode(data:bytes, base:int=0) -> np.ndarray:
+    '''
+    Decodes a whole ROM into a structured array with one row per instruction word,
+    branch targets are resolved with the same PSET page join as Instruction.parse
+    '''
+    t = tables()
+    words = rom_array(data)
+    n = len(words)
+
+    out = np.empty(n, ROM_DTYPE)
+    out["addr"] = base + 2 * np.arange(n, dtype=np.uint32)
+    out["word"] = words
+    out["mnemonic"] = t.mnemonic[words]
+    out["op1_kind"] = t.op_kind[0, words]
+    out["op1_value"] = t.op_value[0, words]
+    out["op2_kind"] = t.op_kind[1, words]
+    out["op2_value"] = t.op_value[1, words]
+    out["branch"] = t.branch[words]
+
+    addr = out["addr"].astype(np.int32)
+
+    # Page of the last PSET at or before every word in the same bank
+    is_pset = out["mnemonic"] == t.pset_id
+    last = np.maximum.accumulate(np.where(is_pset, np.arange(n), -1))
+    in_bank = (last >= 0) & ((base + 2 * last) // BANK_SIZE == addr // BANK_SIZE)
+    page = np.where(in_bank, words[np.maximum(last, 0)] & 31, PSetFinder.DEFAULT.op1[0]).astype(np.int32)
+
+    s = (words & 0xFF).astype(np.int32)
+    # PCB, bit 12 of the word address
+    bank = (addr >> 1) & (1 << 12)
+    kind = t.target_kind[words]
+
+    target = np.full(n, -1, np.int32)
+    target = np.where(kind == PAGE_JUMP, 2 * ((page << 8) | s), target)
+    target = np.where(kind == PAGE_CALL, 2 * (bank | ((page & 15) << 8) | s), target)
+    target = np.where(kind == ZERO_CALL, 2 * (bank | s), target)
+    out["target"] = target
+
+    return out
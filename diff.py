@@ -0,0 +1,110 @@
+import hashlib
+from array import array
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from .disassembler import rom_words
+from .fingerprint import normalise
+
+# Share of basic blocks two functions need in common to count as the same, changed, function
+MIN_SHARED = 0.5
+
+@dataclass
+class DiffResult:
+    # (old address, new address)
+    unchanged:List[Tuple[int, int]] = field(default_factory=list)
+    # (old address, new address, share of blocks in common)
+    changed:List[Tuple[int, int, float]] = field(default_factory=list)
+    added:List[int] = field(default_factory=list)
+    removed:List[int] = field(default_factory=list)
+
+def block_hash(data:bytes) -> bytes:
+    '''
+    Relocation insensitive hash of a basic block
+    '''
+    words = array("H", [normalise(w) for w in rom_words(data)])
+    return hashlib.blake2b(words.tobytes(), digest_size=8).digest()
+
+def function_blocks(bv):
+    '''
+    Maps function start -> block hashes in address order
+    '''
+    funcs = {}
+    for func in bv.functions:
+        blocks = sorted(func.basic_blocks, key=lambda bb: bb.start)
+        funcs[func.start] = tuple(block_hash(bv.read(bb.start, bb.end - bb.start)) for bb in blocks)
+    return funcs
+
+def _shared(a, b) -> float:
+    common = len(set(a) & set(b))
+    return common / max(len(set(a) | set(b)), 1)
+
+def diff_views(old, new) -> DiffResult:
+    '''
+    Aligns the functions of two ROM revisions by the hashes of their basic blocks.
+    PSET pages and branch addresses are masked out, so code that only moved is unchanged
+    '''
+    result = DiffResult()
+    old_funcs = function_blocks(old)
+    new_funcs = function_blocks(new)
+
+    # Identical block sequences
+    by_hash = {}
+    for addr, blocks in old_funcs.items():
+        by_hash.setdefault(blocks, []).append(addr)
+
+    pending_new = []
+    for addr, blocks in sorted(new_funcs.items()):
+        candidates = by_hash.get(blocks)
+        if candidates:
+            old_addr = candidates.pop(0)
+            result.unchanged.append((old_addr, addr))
+            del old_funcs[old_addr]
+        else:
+            pending_new.append(addr)
+
+    # Pair up what's left by the blocks they still share
+    by_block = {}
+    for addr, blocks in old_funcs.items():
+        for h in set(blocks):
+            by_block.setdefault(h, set()).add(addr)
+
+    pairs = []
+    for addr in pending_new:
+        blocks = new_funcs[addr]
+        candidates = set()
+        for h in set(blocks):
+            candidates |= by_block.get(h, set())
+        for old_addr in candidates:
+            score = _shared(old_funcs[old_addr], blocks)
+            if score >= MIN_SHARED:
+                pairs.append((score, old_addr, addr))
+
+    matched_old = set()
+    matched_new = set()
+    for score, old_addr, addr in sorted(pairs, reverse=True):
+        if old_addr in matched_old or addr in matched_new:
+            continue
+        matched_old.add(old_addr)
+        matched_new.add(addr)
+        result.changed.append((old_addr, addr, score))
+
+    result.added = [addr for addr in pending_new if addr not in matched_new]
+    result.removed = sorted(addr for addr in old_funcs if addr not in matched_old)
+    result.changed.sort(key=lambda x: x[1])
+
+    return result
+
+def port_names(old, new, result:DiffResult) -> int:
+    '''
+    Carries analyst function names from the old revision over to matched functions in the new one
+    '''
+    count = 0
+    for old_addr, addr, *_ in result.unchanged + result.changed:
+        old_func = old.get_function_at(old_addr)
+        func = new.get_function_at(addr)
+        if old_func is None or func is None or old_func.symbol.auto or not func.symbol.auto:
+            continue
+        func.name = old_func.name
+        count += 1
+    return count
@@ -1,13 +1,15 @@
-from typing import Dict
+from typing import Callable, Dict, Optional, Tuple
 from functools import lru_cache
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import bisect
-from collections import defaultdict
+import threading
+import weakref
 
 from binaryninja import (
     InstructionTextToken,
     InstructionTextTokenType,
-    BranchType
+    BranchType,
+    log_warn
 )
 
 # TODO replace all calls of this 
@@ -16,6 +18,15 @@ from binaryninja import (
 def dec(binary:str):
     return int(binary, 2)
 
+def rom_words(data:bytes):
+    '''
+    Splits raw ROM bytes into 12 bit instruction words (2 bytes per word, big endian)
+    '''
+    return [((data[i] & 15) << 8) | data[i + 1] for i in range(0, len(data) - 1, 2)]
+
+# Bytes per bank, PCB selects one of the 0x1000 word banks
+BANK_SIZE = 0x2000
+
 @dataclass
 class BranchInfo:
     _type:BranchType
@@ -47,7 +58,7 @@ class Instruction:
         ('IY', REG_DEREF)
     ]
 
-    def __init__(self, data:bytes, addr:int):
+    def __init__(self, data:bytes, addr:int, pset_finder=None):
         if len(data) == 0:
             raise ValueError("Zero length bytes to decode")
         elif len(data) < 2:
@@ -57,13 +68,15 @@ class Instruction:
 
         self.data = data
         self.addr = addr
+        # Index to look up the active PSET in, the global one when None
+        self.pset_finder = pset_finder
 
         # "Macros" to make parsing easier
         self.value = (data[0] << 8) | data[1]
         self.upper_word = data[0] & 15
         self.middle_word = (data[1] & 240) >> 4
         self.lower_word = data[1] & 15
-        self.middle_low = data[1] & 48 >> 4
+        self.middle_low = (data[1] & 48) >> 4
         self.low_low = data[1] & 3
 
         self.p = data[1] & 31
@@ -80,6 +93,14 @@ class Instruction:
 
         self.parse()
 
+    def bank_bit(self):
+        # PCB is bit 12 of the word address, self.addr is a byte address
+        return (self.addr >> 1) & (1 << 12)
+
+    def get_pset(self):
+        finder = psets if self.pset_finder is None else self.pset_finder
+        return finder.get(self.addr)
+
     def parse(self):
         # BRANCH INSTRUCTIONS
         if self.upper_word == dec('1110') and (self.middle_word >> 1) == dec('010'):
@@ -91,7 +112,7 @@ class Instruction:
             self.mnemonic = "JP"
             self.op1 = (self.s, ADDR)
                        
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
             target_addr = 2 * ((pset.op1[0] << 8) | self.s)
             self.branches.append(BranchInfo(_type=BranchType.UnconditionalBranch, target=target_addr))
             return
@@ -101,7 +122,7 @@ class Instruction:
             self.op1 = ("C", STR)
             self.op2 = (self.s, ADDR)
 
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
             target_addr = 2 * ((pset.op1[0] << 8) | self.s)
             self.branches.append(BranchInfo(_type=BranchType.TrueBranch, target=target_addr))
             self.branches.append(BranchInfo(_type=BranchType.FalseBranch, target=self.addr+2))
@@ -112,7 +133,7 @@ class Instruction:
             self.op1 = ("NC", STR)
             self.op2 = (self.s, ADDR)
 
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
             target_addr = 2 * ((pset.op1[0] << 8) | self.s)
             self.branches.append(BranchInfo(_type=BranchType.TrueBranch, target=target_addr))
             self.branches.append(BranchInfo(_type=BranchType.FalseBranch, target=self.addr+2))
@@ -123,7 +144,7 @@ class Instruction:
             self.op1 = ("Z", STR)
             self.op2 = (self.s, ADDR)
 
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
             target_addr = 2 * ((pset.op1[0] << 8) | self.s)
             self.branches.append(BranchInfo(_type=BranchType.TrueBranch, target=target_addr))
             self.branches.append(BranchInfo(_type=BranchType.FalseBranch, target=self.addr+2))
@@ -134,7 +155,7 @@ class Instruction:
             self.op1 = ("NZ", STR)
             self.op2 = (self.s, ADDR)
 
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
             target_addr = 2 * ((pset.op1[0] << 8) | self.s)
             self.branches.append(BranchInfo(_type=BranchType.TrueBranch, target=target_addr))
             self.branches.append(BranchInfo(_type=BranchType.FalseBranch, target=self.addr+2))
@@ -150,11 +171,11 @@ class Instruction:
             self.op1 = (self.s, ADDR)
             
             
-            pset = psets.get(self.addr)
+            pset = self.get_pset()
 
             # NBP not used
             # Bank of Current PC | Page set by PSET | op1
-            target_addr = self.addr & (1 << 13)
+            target_addr = self.bank_bit()
             target_addr |= (pset.op1[0] & 15) << 8
             target_addr |= self.s
             target_addr = 2 * target_addr
@@ -167,7 +188,7 @@ class Instruction:
             self.op1 = (self.s, ADDR)
 
             # Bank of Current PC | Page 0 | op1
-            target_addr = self.addr & (1 << 13)
+            target_addr = self.bank_bit()
             target_addr |= self.s
             target_addr = 2 * target_addr
             self.branches.append(BranchInfo(_type=BranchType.CallDestination, target=target_addr))
@@ -718,8 +739,8 @@ class Disassembler:
 
         return value, token_type
 
-    def disasm(self, data, addr):
-        instr = Instruction(data, addr)
+    def disasm(self, data, addr, pset_finder=None):
+        instr = Instruction(data, addr, pset_finder)
 
         tokens = [InstructionTextToken(InstructionTextTokenType.InstructionToken, instr.mnemonic)]
         if instr.op1 is not None:
@@ -737,6 +758,17 @@ class Disassembler:
 
         return tokens, instr.branches
 
+@dataclass(frozen=True)
+class PSetSnapshot:
+    version:int = 0
+    # Sorted PSET addresses and their instructions, index for index
+    addrs:Tuple[int, ...] = ()
+    instrs:Tuple[Instruction, ...] = ()
+    # While a sweep is still running only PSETs below frontier are indexed,
+    # lookups at or above it go to fallback(addr, frontier). None once complete
+    frontier:Optional[int] = None
+    fallback:Optional[Callable[[int, int], Optional[Instruction]]] = None
+
 class PSetFinder:
     '''
     Data structure for returning the largest address smaller than the given address on retrieval
@@ -752,44 +784,185 @@ class PSetFinder:
        .--------------.
        | BRANCH INSTR |
        `--------------'
+
+    Binary Ninja calls into the architecture from several analysis threads at once,
+    so the index is published as immutable snapshots. Readers grab the current snapshot
+    with a single attribute load and never lock or allocate, writers build a new
+    snapshot under a lock and swap it in
+
+    The index can also be filled progressively (see begin_discovery), lookups past
+    what has been swept so far are answered on demand by the fallback
     '''
     DEFAULT = Instruction(b'\x0e\x41', addr=None)
 
-    def __init__(self, bin_size=256):
-        self.bin_size = bin_size
-        self.psets = defaultdict(lambda: [list(), 0])
-        self.history = set()
-        self._size = 0
+    def __init__(self):
+        self._snapshot = PSetSnapshot()
+        self._lock = threading.Lock()
 
     def __len__(self):
-        return self._size
+        return len(self._snapshot.addrs)
 
-    def add(self, addr:int, instr:Instruction):
-        if addr in self.history:
-            return
+    @property
+    def snapshot(self) -> PSetSnapshot:
+        return self._snapshot
 
-        self.history.add(addr)
-        self._size += 1
-        key = addr // self.bin_size
-        bin = self.psets[key]
-        bisect.insort(bin[0], instr, key=lambda x: x.addr)
-        # Update the minimum address found in this bin
-        if instr.addr < bin[1]:
-            bin[1] = instr.addr
+    @property
+    def complete(self) -> bool:
+        return self._snapshot.frontier is None
+
+    def add(self, addr:int, instr:Instruction):
+        self.update([(addr, instr)])
+
+    def update(self, items, frontier:int=None):
+        '''
+        Adds many (addr, PSET instruction) pairs and publishes them as one new snapshot.
+        Addresses already in the index keep their original instruction.
+        During discovery frontier moves the swept boundary up to the given address
+        '''
+        with self._lock:
+            current = self._snapshot
+            merged = dict(zip(current.addrs, current.instrs))
+            added = False
+            for addr, instr in items:
+                if addr not in merged:
+                    merged[addr] = instr
+                    added = True
+
+            new_frontier = current.frontier
+            if frontier is not None and current.frontier is not None:
+                new_frontier = max(current.frontier, frontier)
+            if not added and new_frontier == current.frontier:
+                return
+
+            addrs = tuple(sorted(merged))
+            self._snapshot = replace(current,
+                version=current.version + 1,
+                addrs=addrs,
+                instrs=tuple(merged[addr] for addr in addrs),
+                frontier=new_frontier
+            )
+
+    def begin_discovery(self, fallback:Callable[[int, int], Optional[Instruction]], frontier:int=0):
+        '''
+        Marks the index as incomplete from frontier on. Until finish_discovery, lookups at
+        or above the frontier call fallback(addr, frontier) which returns the last PSET in
+        [frontier, addr] or None if there isn't one
+        '''
+        with self._lock:
+            current = self._snapshot
+            self._snapshot = replace(current, version=current.version + 1, frontier=frontier, fallback=fallback)
+
+    def finish_discovery(self):
+        with self._lock:
+            current = self._snapshot
+            self._snapshot = replace(current, version=current.version + 1, frontier=None, fallback=None)
 
     def get(self, addr) -> Instruction:
-        key = addr // self.bin_size
-        bin = self.psets[key]
-        while addr < bin[1]:
-            key -= 1
-            if key < 0:
-                return PSetFinder.DEFAULT
-            bin = self.psets[key]
-        
-        i = bisect.bisect_right(bin[0], addr, key=lambda x: x.addr)
+        snapshot = self._snapshot
+        if snapshot.frontier is not None and addr >= snapshot.frontier:
+            instr = snapshot.fallback(addr, snapshot.frontier)
+            if instr is not None:
+                return instr
+
+        i = bisect.bisect_right(snapshot.addrs, addr)
         if i:
-            return bin[0][i-1]
+            return snapshot.instrs[i-1]
 
         return PSetFinder.DEFAULT
 
-psets = PSetFinder()
\ No newline at end of file
+class BankMap:
+    '''
+    Lazily built per-bank values: factory(number) makes a bank's value the first time
+    it's asked for. Lookups are lock free once the bank exists
+    '''
+    def __init__(self, factory:Callable[[int], object]):
+        self._factory = factory
+        self._banks = {}
+        self._lock = threading.Lock()
+
+    def values(self):
+        return list(self._banks.values())
+
+    def get(self, number:int):
+        value = self._banks.get(number)
+        if value is not None:
+            return value
+
+        with self._lock:
+            value = self._banks.get(number)
+            if value is None:
+                value = self._factory(number)
+                # Swap in a new dict so readers never see one mid-update
+                self._banks = {**self._banks, number: value}
+        return value
+
+class BankedPSetFinder:
+    '''
+    A PSetFinder per bank. PSET only selects a page within the bank a branch lands in,
+    so lookups never cross a bank boundary.
+
+    Banks are indexed on first touch by loader(bank, finder), which fills the new
+    finder (or starts a discovery on it). Banks nobody looks at cost nothing
+    '''
+    def __init__(self, loader:Callable[[int, PSetFinder], None]=None):
+        self._loader = loader
+        self._banks = BankMap(self._new_bank)
+
+    def __len__(self):
+        return sum(len(finder) for finder in self._banks.values())
+
+    @property
+    def complete(self) -> bool:
+        return all(finder.complete for finder in self._banks.values())
+
+    def _new_bank(self, number:int) -> PSetFinder:
+        finder = PSetFinder()
+        if self._loader is not None:
+            self._loader(number, finder)
+        return finder
+
+    def bank(self, addr:int) -> PSetFinder:
+        return self._banks.get(addr // BANK_SIZE)
+
+    def add(self, addr:int, instr:Instruction):
+        self.bank(addr).add(addr, instr)
+
+    def update(self, items):
+        by_bank = {}
+        for addr, instr in items:
+            by_bank.setdefault(addr // BANK_SIZE, []).append((addr, instr))
+        for number, bank_items in by_bank.items():
+            self.bank(number * BANK_SIZE).update(bank_items)
+
+    def get(self, addr) -> Instruction:
+        return self.bank(addr).get(addr)
+
+class PSetRegistry:
+    '''
+    A BankedPSetFinder per open ROM, keyed by content hash, so opening a ROM never
+    drops the banks another view has indexed. A finder lives as long as a view holds it.
+
+    Binary Ninja doesn't tell the architecture callbacks which view they're decoding for,
+    so lookups through here (Instructions without a pset_finder) follow the ROM opened last.
+    Anything that has the view at hand passes the view's own finder instead
+    '''
+    def __init__(self):
+        self._roms = weakref.WeakValueDictionary()
+        self._active = BankedPSetFinder()
+        self._lock = threading.Lock()
+
+    def open(self, key:str, loader:Callable[[int, PSetFinder], None]) -> BankedPSetFinder:
+        with self._lock:
+            finder = self._roms.get(key)
+            if finder is None:
+                finder = self._roms[key] = BankedPSetFinder(loader)
+            if any(other != key for other in self._roms.keys()):
+                log_warn("E0C6S46: another ROM is open, its disassembly now follows the PSETs of the ROM opened last. "
+                    "Jump tables, the instruction index and diffs still use each view's own PSETs")
+            self._active = finder
+        return finder
+
+    def get(self, addr) -> Instruction:
+        return self._active.get(addr)
+
+psets = PSetRegistry()
@@ -0,0 +1,163 @@
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import os
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from binaryninja import InstructionTextTokenType
+
+from .disassembler import Disassembler, Instruction, PSetFinder, BANK_SIZE
+
+# Bytes of ROM read at a time, must be even
+READ_CHUNK = 1 << 16
+# Lines buffered before each write
+WRITE_CHUNK = 4096
+
+_OPENERS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open,
+}
+
+@dataclass
+class ListingRecord:
+    rom:str
+    addr:int
+    word:int
+    text:str
+    # (BranchType name, target or None)
+    branches:List[Tuple[str, int]] = field(default_factory=list)
+    comment:str = None
+
+class RunningPSet:
+    '''
+    Stands in for PSetFinder while streaming: the last PSET seen in the current bank is the one in effect
+    '''
+    def __init__(self):
+        self.last = PSetFinder.DEFAULT
+
+    def get(self, addr) -> Instruction:
+        return self.last
+
+def iter_listing(path:str):
+    '''
+    Yields a ListingRecord per instruction word of the ROM at path,
+    reading it in fixed size chunks so memory use doesn't grow with the ROM
+    '''
+    disassembler = Disassembler()
+    rom = os.path.basename(path)
+    pset = RunningPSet()
+    addr = 0
+
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if len(chunk) < 2:
+                return
+
+            for i in range(0, len(chunk) - 1, 2):
+                data = chunk[i:i + 2]
+                if addr % BANK_SIZE == 0:
+                    pset.last = PSetFinder.DEFAULT
+                tokens, branches = disassembler.disasm(data, addr, pset)
+
+                text = []
+                comment = None
+                for token in tokens:
+                    if token.type == InstructionTextTokenType.CommentToken:
+                        comment = token.text.strip()
+                    else:
+                        text.append(token.text)
+
+                if tokens[0].text == "PSET":
+                    pset.last = Instruction(data, addr)
+
+                yield ListingRecord(
+                    rom=rom,
+                    addr=addr,
+                    word=((data[0] & 15) << 8) | data[1],
+                    text="".join(text),
+                    branches=[(b._type.name, b.target) for b in branches],
+                    comment=comment
+                )
+                addr += 2
+
+def open_sink(path:str):
+    '''
+    Opens path for text output, compressed if it ends in .gz, .xz or .bz2
+    '''
+    opener = _OPENERS.get(os.path.splitext(path)[1])
+    if opener is not None:
+        return opener(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="", buffering=1 << 20)
+
+def format_of(path:str) -> str:
+    root, ext = os.path.splitext(path)
+    if ext in _OPENERS:
+        ext = os.path.splitext(root)[1]
+    return {".jsonl": "jsonl", ".csv": "csv"}.get(ext, "text")
+
+def _text_line(record:ListingRecord) -> str:
+    line = f"{record.addr:04x}: {record.word:03x}  {record.text}"
+    if record.comment:
+        line += f"  ; {record.comment}"
+    return line + "\n"
+
+def _jsonl_line(record:ListingRecord) -> str:
+    return json.dumps({
+        "rom": record.rom,
+        "addr": record.addr,
+        "word": record.word,
+        "text": record.text,
+        "branches": record.branches,
+        "comment": record.comment,
+    }) + "\n"
+
+CSV_COLUMNS = ["rom", "addr", "word", "text", "branches", "comment"]
+
+def _csv_line(record:ListingRecord) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerow([
+        record.rom,
+        record.addr,
+        record.word,
+        record.text,
+        " ".join(f"{name}:{'' if target is None else hex(target)}" for name, target in record.branches),
+        record.comment or "",
+    ])
+    return buf.getvalue()
+
+def export(paths, out_path:str, fmt:str=None) -> int:
+    '''
+    Streams the listings of one or many ROMs into out_path as text, jsonl or csv
+    (guessed from the extension when fmt is None). Returns the number of instructions written
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    fmt = fmt or format_of(out_path)
+    line = {"text": _text_line, "jsonl": _jsonl_line, "csv": _csv_line}[fmt]
+
+    count = 0
+    with open_sink(out_path) as out:
+        if fmt == "csv":
+            out.write(",".join(CSV_COLUMNS) + "\r\n")
+
+        pending = []
+        for path in paths:
+            if fmt == "text":
+                pending.append(f"; {os.path.basename(path)}\n")
+
+            for record in iter_listing(path):
+                pending.append(line(record))
+                count += 1
+                if len(pending) >= WRITE_CHUNK:
+                    out.write("".join(pending))
+                    pending.clear()
+
+        out.write("".join(pending))
+
+    return count
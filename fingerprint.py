@@ -0,0 +1,173 @@
+import json
+import os
+import random
+
+from binaryninja import log_info
+
+from . import cache
+from .disassembler import rom_words
+
+# MinHash signature is BANDS * ROWS hashes long
+BANDS = 16
+ROWS = 4
+SHINGLE = 3
+# Functions shorter than this are too generic to identify reliably
+MIN_WORDS = 6
+# Estimated Jaccard similarity required to accept a match
+THRESHOLD = 0.8
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0xE0C6)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(BANDS * ROWS)]
+
+def normalise(word:int) -> int:
+    '''
+    Masks the operands that change when code is relocated so the same routine
+    hashes the same on any PSET page or bank
+    '''
+    upper = word >> 8
+    # JP, JP C/NC/Z/NZ, CALL, CALZ: s (lower 8 bits) is an absolute address
+    if upper in (0, 2, 3, 4, 5, 6, 7):
+        return word & 0xF00
+    # PSET: p (lower 5 bits) is the target page
+    if word & 0xFE0 == 0xE40:
+        return 0xE40
+    return word
+
+def function_words(bv, func):
+    '''
+    Instruction words of a function in address order
+    '''
+    words = []
+    for bb in sorted(func.basic_blocks, key=lambda bb: bb.start):
+        words.extend(rom_words(bv.read(bb.start, bb.end - bb.start)))
+    return words
+
+def signature(words):
+    '''
+    MinHash signature over the n-grams of the normalised words
+    or None if the function is too short to fingerprint
+    '''
+    if len(words) < MIN_WORDS:
+        return None
+
+    words = [normalise(w) for w in words]
+    shingles = set()
+    for i in range(len(words) - SHINGLE + 1):
+        shingle = 0
+        for w in words[i:i + SHINGLE]:
+            shingle = (shingle << 12) | w
+        shingles.add(shingle)
+
+    return tuple(min((a * x + b) % _PRIME for x in shingles) for a, b in _PERMUTATIONS)
+
+def similarity(sig1, sig2) -> float:
+    return sum(x == y for x, y in zip(sig1, sig2)) / len(sig1)
+
+class FunctionIndex:
+    '''
+    Locality sensitive hash index of known function signatures.
+
+    Each signature is split into BANDS bands of ROWS hashes. Two functions
+    share a bucket if any band is identical, so a lookup only compares
+    against the few entries in its buckets instead of the whole corpus.
+    '''
+    def __init__(self):
+        self.entries = []
+        self.buckets = {}
+        self._known = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _bands(self, sig):
+        for band in range(BANDS):
+            yield (band,) + sig[band * ROWS:(band + 1) * ROWS]
+
+    def add(self, name:str, sig) -> bool:
+        '''
+        Adds a known function, returns False if this name and signature are already indexed
+        '''
+        sig = tuple(sig)
+        if (name, sig) in self._known:
+            return False
+        self._known.add((name, sig))
+
+        i = len(self.entries)
+        self.entries.append((name, sig))
+        for key in self._bands(sig):
+            self.buckets.setdefault(key, []).append(i)
+        return True
+
+    def lookup(self, sig):
+        '''
+        Returns (name, similarity) of the closest known function or None
+        '''
+        candidates = set()
+        for key in self._bands(sig):
+            candidates.update(self.buckets.get(key, ()))
+
+        best = None
+        for i in candidates:
+            name, other = self.entries[i]
+            score = similarity(sig, other)
+            if score >= THRESHOLD and (best is None or score > best[1]):
+                best = (name, score)
+        return best
+
+    def add_view(self, bv) -> int:
+        '''
+        Adds every function in the view that an analyst has named
+        '''
+        count = 0
+        for func in bv.functions:
+            if func.symbol.auto:
+                continue
+            sig = signature(function_words(bv, func))
+            if sig is not None and self.add(func.name, sig):
+                count += 1
+        return count
+
+    def label_view(self, bv, functions=None) -> int:
+        '''
+        Names every auto named function in the view (or in functions) that matches a known function
+        '''
+        count = 0
+        for func in bv.functions if functions is None else functions:
+            if not func.symbol.auto:
+                continue
+            sig = signature(function_words(bv, func))
+            if sig is None:
+                continue
+            match = self.lookup(sig)
+            if match is not None:
+                func.name = match[0]
+                count += 1
+
+        log_info(f"Labelled {count} functions from {len(self)} known signatures")
+        return count
+
+    @classmethod
+    def path(cls) -> str:
+        return os.path.join(cache.cache_dir(), "functions.json")
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        try:
+            with open(cls.path(), "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return index
+
+        for name, sig in entries:
+            if len(sig) == BANDS * ROWS:
+                index.add(name, sig)
+        return index
+
+    def save(self):
+        os.makedirs(cache.cache_dir(), exist_ok=True)
+        tmp = f"{self.path()}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path())
@@ -0,0 +1,186 @@
+import bisect
+import sys
+from array import array
+from typing import Callable, Iterable
+
+from .disassembler import Instruction, BankMap, rom_words, IMM, ADDR
+
+METADATA_KEY = "e0c6s46.instruction_index"
+# Bump when the key format or decoding changes
+INDEX_VERSION = 2
+
+def _encode(key) -> str:
+    return ":".join(str(part) for part in key)
+
+def _decode(text:str):
+    field, *rest = text.split(":")
+    if field in ("op1", "op2", "operand"):
+        kind = int(rest[0])
+        value = rest[1] if kind not in (IMM, ADDR) else int(rest[1])
+        return (field, kind, value)
+    if field == "target":
+        return (field, int(rest[0]))
+    return (field, rest[0])
+
+class InstructionIndex:
+    '''
+    Inverted index from decoded instruction features to the addresses that have them
+
+    Keys:
+        ("mnemonic", "LD")
+        ("op1", kind, value)     e.g. ("op1", REG, "XP") every write to XP
+        ("op2", kind, value)
+        ("operand", kind, value) either operand
+        ("target", addr)         branches to addr
+
+    Queries return sets of addresses so they combine with & | -
+    '''
+    def __init__(self):
+        self.postings = {}
+        self._ranges = None
+
+    def __len__(self):
+        return len(self.postings)
+
+    def _post(self, key, addr:int):
+        postings = self.postings.get(key)
+        if postings is None:
+            postings = self.postings[key] = array("I")
+        postings.append(addr)
+
+    @classmethod
+    def build(cls, rom:bytes, base:int=0, pset_finder=None):
+        index = cls()
+        for i, word in enumerate(rom_words(rom)):
+            addr = base + 2 * i
+            instr = Instruction(word.to_bytes(2, "big"), addr, pset_finder)
+            index._post(("mnemonic", instr.mnemonic), addr)
+            for field, op in (("op1", instr.op1), ("op2", instr.op2)):
+                if op is None:
+                    continue
+                value, kind = op
+                index._post((field, kind, value), addr)
+                index._post(("operand", kind, value), addr)
+            for branch in instr.branches:
+                if branch.target is not None:
+                    index._post(("target", branch.target), addr)
+        return index
+
+    def get(self, key) -> set:
+        return set(self.postings.get(key, ()))
+
+    def find(self, mnemonic=None, op1=None, op2=None, operand=None, target=None) -> set:
+        '''
+        Addresses matching every given feature. Operands are (value, kind) like Instruction.op1
+
+        e.g. every LD to memory address 0xF: find(mnemonic="LD", op1=(0xF, ADDR))
+        '''
+        keys = []
+        if mnemonic is not None:
+            keys.append(("mnemonic", mnemonic))
+        for field, op in (("op1", op1), ("op2", op2), ("operand", operand)):
+            if op is not None:
+                keys.append((field, op[1], op[0]))
+        if target is not None:
+            keys.append(("target", target))
+        if not keys:
+            raise ValueError("No features to search for")
+
+        # Intersect starting from the rarest feature
+        lists = sorted((self.postings.get(key, ()) for key in keys), key=len)
+        result = set(lists[0])
+        for postings in lists[1:]:
+            if not result:
+                break
+            result.intersection_update(postings)
+        return result
+
+    def range(self, field:str, kind:int, lo:int, hi:int) -> set:
+        '''
+        Addresses whose numeric operand in field ("op1", "op2" or "operand") is within [lo, hi]
+
+        e.g. every RETD returning 0x10 to 0x1F: find(mnemonic="RETD") & range("op1", IMM, 0x10, 0x1F)
+        '''
+        if self._ranges is None:
+            self._ranges = {}
+            for key in self.postings:
+                if key[0] in ("op1", "op2", "operand") and key[1] in (IMM, ADDR):
+                    self._ranges.setdefault(key[:2], []).append(key[2])
+            for values in self._ranges.values():
+                values.sort()
+
+        values = self._ranges.get((field, kind), [])
+        result = set()
+        for value in values[bisect.bisect_left(values, lo):bisect.bisect_right(values, hi)]:
+            result.update(self.postings[(field, kind, value)])
+        return result
+
+    def store(self, bv, bank:int):
+        '''
+        Saves the index of one bank in the view's metadata so it's kept in the .bndb
+        '''
+        postings = {}
+        for key, addrs in self.postings.items():
+            addrs = array("I", addrs)
+            if sys.byteorder == "big":
+                addrs.byteswap()
+            postings[_encode(key)] = addrs.tobytes()
+        bv.store_metadata(f"{METADATA_KEY}.{bank}", {"version": INDEX_VERSION, "postings": postings})
+
+    @classmethod
+    def load(cls, bv, bank:int):
+        '''
+        Returns the index of one bank saved in the view's metadata or None
+        '''
+        try:
+            stored = bv.query_metadata(f"{METADATA_KEY}.{bank}")
+        except KeyError:
+            return None
+        if stored.get("version") != INDEX_VERSION:
+            return None
+
+        index = cls()
+        for text, raw in stored["postings"].items():
+            addrs = array("I")
+            addrs.frombytes(bytes(raw))
+            if sys.byteorder == "big":
+                addrs.byteswap()
+            index.postings[_decode(text)] = addrs
+        return index
+
+class BankedInstructionIndex:
+    '''
+    An InstructionIndex per bank, built (or loaded) by loader(bank) the first time
+    a query reaches the bank. Results are only merged across banks at query time.
+
+    Queries take the same arguments as InstructionIndex plus banks, the bank numbers
+    to search (every bank by default)
+    '''
+    def __init__(self, loader:Callable[[int], InstructionIndex], count:int):
+        self.count = count
+        self._banks = BankMap(loader)
+
+    def bank(self, number:int) -> InstructionIndex:
+        return self._banks.get(number)
+
+    def _each(self, banks:Iterable[int]):
+        for number in range(self.count) if banks is None else banks:
+            yield self.bank(number)
+
+    def get(self, key, banks:Iterable[int]=None) -> set:
+        result = set()
+        for index in self._each(banks):
+            result |= index.get(key)
+        return result
+
+    def find(self, mnemonic=None, op1=None, op2=None, operand=None, target=None, banks:Iterable[int]=None) -> set:
+        result = set()
+        for index in self._each(banks):
+            result |= index.find(mnemonic, op1, op2, operand, target)
+        return result
+
+    def range(self, field:str, kind:int, lo:int, hi:int, banks:Iterable[int]=None) -> set:
+        result = set()
+        for index in self._each(banks):
+            result |= index.range(field, kind, lo, hi)
+        return result
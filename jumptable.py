@@ -0,0 +1,176 @@
+from .disassembler import Instruction, rom_words, REG, IMM
+
+# JPBA can only reach 16 * 16 addresses in the current page
+MAX_TARGETS = 256
+# How many blocks back from a JPBA we follow the CFG, A and B are unknown past that
+MAX_BLOCKS = 64
+
+JPBA = 0b111111101000
+
+TOP = frozenset(range(16))
+
+# Instructions that name A or B as op1 without writing it
+_READS_OP1 = ("CP", "FAN", "PUSH")
+
+def _transfer(instr:Instruction, regs:dict):
+    '''
+    Applies one instruction to the possible values of A and B
+    '''
+    if instr.mnemonic in ("CALL", "CALZ"):
+        # Calls don't end Binary Ninja blocks, the callee can leave anything in A and B
+        for reg in regs:
+            regs[reg] = TOP
+        return
+    if instr.op1 is None or instr.op1[1] != REG or instr.op1[0] not in regs:
+        return
+    if instr.mnemonic in _READS_OP1:
+        return
+
+    dst = instr.op1[0]
+    values = regs[dst]
+    src, kind = instr.op2 if instr.op2 is not None else (None, None)
+
+    if instr.mnemonic == "LD" and kind == IMM:
+        regs[dst] = frozenset([src])
+    elif instr.mnemonic == "LD" and kind == REG and src in regs:
+        regs[dst] = regs[src]
+    elif kind == IMM and instr.mnemonic == "ADD":
+        regs[dst] = frozenset((v + src) & 15 for v in values)
+    elif kind == IMM and instr.mnemonic == "ADC":
+        # Carry is unknown
+        regs[dst] = frozenset((v + src + c) & 15 for v in values for c in (0, 1))
+    elif kind == IMM and instr.mnemonic == "AND":
+        regs[dst] = frozenset(v & src for v in values)
+    elif kind == IMM and instr.mnemonic == "OR":
+        regs[dst] = frozenset(v | src for v in values)
+    elif kind == IMM and instr.mnemonic == "XOR":
+        regs[dst] = frozenset(v ^ src for v in values)
+    else:
+        regs[dst] = TOP
+
+class JumpTableResolver:
+    '''
+    Recovers the targets of JPBA (PC <- NPP:B:A) with a small value set analysis.
+
+    Collects the blocks that can reach the JPBA's block through the function's CFG,
+    then runs forward over them to a fixed point, joining the sets of values A and B
+    can hold where paths meet. Function entries and predecessors we don't know
+    (or that are too far away) leave A and B unconstrained.
+
+    Results are cached per site along with the blocks, edges and page they were
+    computed from, so reanalysis only redoes sites whose inputs changed
+    '''
+    def __init__(self):
+        self.cache = {}
+
+    def _blocks(self, bb) -> dict:
+        '''
+        Maps start -> block for bb and the blocks that can reach it, up to MAX_BLOCKS
+        '''
+        blocks = {bb.start: bb}
+        pending = [bb]
+        while pending:
+            for edge in pending.pop().incoming_edges:
+                source = edge.source
+                if source is None or source.start in blocks or len(blocks) >= MAX_BLOCKS:
+                    continue
+                blocks[source.start] = source
+                pending.append(source)
+        return blocks
+
+    def _analyse(self, bv, site:int, site_block:int, preds:dict, words:dict):
+        '''
+        Possible values of A and B right before the JPBA at site
+        '''
+        succs = {}
+        for start, sources in preds.items():
+            for source in sources:
+                if source in preds:
+                    succs.setdefault(source, []).append(start)
+
+        code = {}
+        for start, block_words in words.items():
+            code[start] = [
+                Instruction(word.to_bytes(2, "big"), start + 2 * i, bv.psets)
+                for i, word in enumerate(block_words) if start + 2 * i != site
+            ]
+
+        out = {}
+        pending = list(preds)
+        while pending:
+            start = pending.pop()
+            sources = preds[start]
+            if not sources or any(source not in preds for source in sources):
+                regs = {"A": TOP, "B": TOP}
+            else:
+                reached = [out[source] for source in sources if source in out]
+                if not reached:
+                    continue
+                regs = {reg: frozenset().union(*(state[reg] for state in reached)) for reg in ("A", "B")}
+
+            for instr in code[start]:
+                _transfer(instr, regs)
+
+            if out.get(start) != regs:
+                out[start] = regs
+                pending.extend(succs.get(start, ()))
+
+        return out.get(site_block, {"A": TOP, "B": TOP})
+
+    def resolve(self, bv, bb):
+        '''
+        Returns the sorted targets of the JPBA ending bb or None if A and B are unconstrained
+        '''
+        site = bb.end - 2
+        page = bv.psets.get(site).op1[0]
+
+        blocks = self._blocks(bb)
+        preds = {
+            start: tuple(None if edge.source is None else edge.source.start for edge in block.incoming_edges)
+            for start, block in blocks.items()
+        }
+        words = {
+            start: tuple(rom_words(bv.read(start, block.end - start)))
+            for start, block in blocks.items()
+        }
+
+        inputs = (page, tuple(sorted((start, preds[start], words[start]) for start in blocks)))
+        cached = self.cache.get(site)
+        if cached is not None and cached[0] == inputs:
+            return cached[1]
+
+        regs = self._analyse(bv, site, bb.start, preds, words)
+
+        targets = None
+        if not (regs["A"] == TOP and regs["B"] == TOP) and len(regs["A"]) * len(regs["B"]) <= MAX_TARGETS:
+            targets = tuple(sorted(
+                2 * ((page << 8) | (b << 4) | a)
+                for b in regs["B"] for a in regs["A"]
+            ))
+
+        self.cache[site] = (inputs, targets)
+        return targets
+
+    def apply(self, bv, applied:dict) -> int:
+        '''
+        Feeds resolved targets of every JPBA in the view's functions back to analysis.
+        applied maps site -> targets already handed to Binary Ninja and is updated in place.
+        Returns the number of sites that changed
+        '''
+        changed = 0
+        for func in bv.functions:
+            for bb in func.basic_blocks:
+                site = bb.end - 2
+                if rom_words(bv.read(site, 2)) != [JPBA]:
+                    continue
+
+                targets = self.resolve(bv, bb)
+                if targets is None or applied.get(site) == targets:
+                    continue
+
+                func.set_auto_indirect_branches(site, [(bv.arch, t) for t in targets])
+                applied[site] = targets
+                changed += 1
+        return changed
+
+jump_tables = JumpTableResolver()
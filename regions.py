@@ -0,0 +1,102 @@
+import math
+from dataclasses import dataclass
+from typing import List
+
+from .disassembler import Instruction
+
+CODE = "code"
+FILLER = "filler"
+DATA = "data"
+
+# Shortest run of one repeated word treated as padding
+MIN_FILLER = 16
+# Shortest run of table instructions treated as a data table
+MIN_TABLE = 8
+# Table operands must carry at least this much information (bits per entry),
+# a run of the same few RETDs is more likely a switch in code than a table
+MIN_TABLE_ENTROPY = 2.0
+
+@dataclass
+class Region:
+    kind:str
+    # Word indices, end is exclusive
+    start:int
+    end:int
+
+    def __len__(self):
+        return self.end - self.start
+
+def is_table_word(word:int) -> bool:
+    # RETD e and LBPX MX, e are how the E0C6S46 stores constant tables in ROM
+    return (word >> 8) in (0b0001, 0b1001)
+
+def entropy(values) -> float:
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    total = len(values)
+    return -sum(c / total * math.log2(c / total) for c in counts.values())
+
+def _runs(words, same):
+    '''
+    Yields (start, end) of maximal runs where same(previous, current) holds
+    '''
+    start = 0
+    for i in range(1, len(words) + 1):
+        if i == len(words) or not same(words[i - 1], words[i]):
+            yield start, i
+            start = i
+
+def classify(words) -> List[Region]:
+    '''
+    Splits a ROM into code, filler and data regions that cover every word
+    '''
+    kinds = [CODE] * len(words)
+
+    for start, end in _runs(words, lambda a, b: a == b):
+        if end - start >= MIN_FILLER:
+            kinds[start:end] = [FILLER] * (end - start)
+
+    for start, end in _runs(words, lambda a, b: is_table_word(a) == is_table_word(b)):
+        if not is_table_word(words[start]) or end - start < MIN_TABLE:
+            continue
+        if FILLER in kinds[start:end]:
+            continue
+        if entropy([w & 0xFF for w in words[start:end]]) >= MIN_TABLE_ENTROPY:
+            kinds[start:end] = [DATA] * (end - start)
+
+    regions = []
+    for start, end in _runs(kinds, lambda a, b: a == b):
+        if end > start:
+            regions.append(Region(kinds[start], start, end))
+    return regions
+
+def clip(regions, start:int, end:int) -> List[Region]:
+    '''
+    The parts of regions within the word range [start, end)
+    '''
+    return [
+        Region(region.kind, max(region.start, start), min(region.end, end))
+        for region in regions
+        if region.start < end and region.end > start
+    ]
+
+def sweep_psets(rom:bytes, regions):
+    '''
+    Returns (addr, 12 bit word) of every PSET in the code regions of the ROM
+    '''
+    found = []
+    # Padding and data tables can't hold a PSET that's ever executed
+    for region in regions:
+        if region.kind != CODE:
+            continue
+
+        for addr in range(2 * region.start, 2 * region.end, 2):
+            # Test the bits rather than decoding, a decoded JP/CALL would look
+            # up the global PSET index this sweep may be filling
+            # 1110 010p pppp
+            if ((rom[addr] & 15) << 8 | rom[addr + 1]) & 0xFE0 == 0xE40:
+                instr = Instruction(rom[addr:addr + 2], addr)
+                found.append((instr.addr, instr.value))
+
+    return found
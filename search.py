@@ -0,0 +1,142 @@
+from binaryninja import log_info
+
+from .disassembler import rom_words
+
+TAG_TYPE = "E0C6S46 Pattern"
+
+def parse_pattern(spec:str):
+    '''
+    Parses a pattern into a list of (value, mask) pairs, one per 12 bit word.
+    Words are separated by whitespace, each word is 12 binary digits where
+    "x" or "." is a don't care bit. "_" may be used as a visual separator.
+
+    e.g. CALL anywhere followed by RET: "0100xxxxxxxx 111111011111"
+    '''
+    words = []
+    for word in spec.split():
+        word = word.replace("_", "")
+        if len(word) != 12:
+            raise ValueError(f"Pattern word '{word}' is not 12 bits")
+
+        value = 0
+        mask = 0
+        for bit in word:
+            value <<= 1
+            mask <<= 1
+            if bit in "01":
+                value |= int(bit)
+                mask |= 1
+            elif bit not in "xX.":
+                raise ValueError(f"Invalid pattern bit '{bit}' in '{word}'")
+        words.append((value, mask))
+
+    if not words:
+        raise ValueError("Empty pattern")
+
+    return words
+
+class PatternSet:
+    '''
+    Matches many masked instruction word sequences in a single linear pass.
+
+    All patterns are packed side by side into one bit vector and run as a
+    bit-parallel (shift-and) NFA, so each ROM word costs one shift, one OR and
+    one AND no matter how many patterns there are. Don't care bits make a
+    classic Aho-Corasick DFA blow up, the NFA handles them for free.
+
+    Bit layout for patterns P0 (3 words) and P1 (2 words):
+        bit: 4    3    2    1    0
+            [P1.1 P1.0][P0.2 P0.1 P0.0]
+    '''
+    def __init__(self):
+        self.patterns = []
+        self._compiled = False
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, name:str, spec:str):
+        self.patterns.append((name, parse_pattern(spec)))
+        self._compiled = False
+
+    def compile(self):
+        self._starts = 0
+        self._ends = {}
+        # A word matches a pattern word iff each of its three nibbles does,
+        # so per nibble tables of "which pattern words accept this nibble"
+        # AND together into the full 12 bit table
+        nibbles = [[0] * 16 for _ in range(3)]
+
+        bit = 0
+        for name, words in self.patterns:
+            self._starts |= 1 << bit
+            for value, mask in words:
+                for shift, table in zip((0, 4, 8), nibbles):
+                    v = (value >> shift) & 15
+                    m = (mask >> shift) & 15
+                    for n in range(16):
+                        if n & m == v:
+                            table[n] |= 1 << bit
+                bit += 1
+            self._ends[bit - 1] = (name, len(words))
+
+        self._end_mask = 0
+        for end in self._ends:
+            self._end_mask |= 1 << end
+
+        self._nibbles = nibbles
+        # Filled lazily, a ROM rarely uses all 4096 words
+        self._table = [None] * 4096
+        self._compiled = True
+
+    def _word_bits(self, word:int) -> int:
+        low, mid, high = self._nibbles
+        bits = low[word & 15] & mid[(word >> 4) & 15] & high[word >> 8]
+        self._table[word] = bits
+        return bits
+
+    def scan(self, words):
+        '''
+        Yields (index of first word, pattern name) for every match in words
+        '''
+        if not self._compiled:
+            self.compile()
+
+        state = 0
+        starts = self._starts
+        end_mask = self._end_mask
+        table = self._table
+        for i, word in enumerate(words):
+            bits = table[word]
+            if bits is None:
+                bits = self._word_bits(word)
+            state = ((state << 1) | starts) & bits
+
+            hits = state & end_mask
+            while hits:
+                low = hits & -hits
+                name, length = self._ends[low.bit_length() - 1]
+                yield i - length + 1, name
+                hits ^= low
+
+    def scan_view(self, bv):
+        '''
+        Yields (address, pattern name) for every match in the view's ROM
+        '''
+        for i, name in self.scan(rom_words(bv.read(bv.start, len(bv)))):
+            yield bv.start + 2 * i, name
+
+    def tag_view(self, bv) -> int:
+        '''
+        Scans the view and marks every match with a tag. Returns the number of matches
+        '''
+        if bv.get_tag_type(TAG_TYPE) is None:
+            bv.create_tag_type(TAG_TYPE, "🔍")
+
+        count = 0
+        for addr, name in self.scan_view(bv):
+            bv.add_tag(addr, TAG_TYPE, name, user=False)
+            count += 1
+
+        log_info(f"{count} pattern matches for {len(self)} patterns")
+        return count
@@ -0,0 +1,331 @@
+import os
+import socket
+import socketserver
+import struct
+import threading
+from collections import OrderedDict
+
+from binaryninja import user_directory
+
+from . import cache
+from .disassembler import Disassembler, Instruction, BankedPSetFinder, PSetFinder, rom_words, BANK_SIZE
+from .regions import classify, clip, sweep_psets
+
+#####################################################################
+# Protocol                                                          #
+#####################################################################
+# Every message is a little endian u32 payload length then payload. #
+#                                                                   #
+# Requests start with a u8 op:                                      #
+#   LOAD    | utf-8 path to a ROM file                              #
+#   DECODE  | u32 rom, u32 count, count * u32 addr                  #
+#   LISTING | u32 rom, u32 start addr (even), u32 count             #
+#                                                                   #
+# Responses start with a u8 status, then on OK:                     #
+#   LOAD    | u32 rom                                               #
+#   DECODE  | per addr: u8 entry status, then on ENTRY_OK           #
+#           |   u16 word, u8 branch count,                          #
+#           |   branch count * (u8 BranchType, i32 target or -1),   #
+#           |   u16 text length, utf-8 text                         #
+#   LISTING | utf-8 text, one instruction per line                  #
+# otherwise a utf-8 error message                                   #
+#####################################################################
+
+OP_LOAD = 1
+OP_DECODE = 2
+OP_LISTING = 3
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+# The ROM was evicted or never loaded, LOAD it again
+STATUS_UNKNOWN_ROM = 2
+
+# Per address status in a DECODE response
+ENTRY_OK = 0
+# Odd or past the end of the ROM, nothing else follows for this address
+ENTRY_BAD_ADDR = 1
+
+# Number of ROMs kept decoded in memory
+MAX_ROMS = 16
+
+LENGTH = struct.Struct("<I")
+DECODE_HEADER = struct.Struct("<II")
+LISTING_HEADER = struct.Struct("<III")
+BRANCH = struct.Struct("<Bi")
+
+class Rom:
+    '''
+    A ROM with its own PSET index so requests for different ROMs don't share state,
+    each bank is indexed the first time a request touches it
+    '''
+    def __init__(self, data:bytes):
+        self.data = data
+        # Content hash, set by RomStore
+        self.key = None
+        self.regions = classify(rom_words(data))
+        self.psets = BankedPSetFinder(self.load_bank)
+
+    def load_bank(self, number:int, finder:PSetFinder):
+        start = number * BANK_SIZE
+        end = min(start + BANK_SIZE, len(self.data))
+        if start >= end:
+            return
+
+        key = cache.bank_key(self.data[start:end], number)
+        found = cache.load(key)
+        if found is None:
+            found = sweep_psets(self.data, clip(self.regions, start // 2, end // 2))
+            cache.store(key, found)
+        finder.update((addr, Instruction(word.to_bytes(2, "big"), addr)) for addr, word in found)
+
+class RomStore:
+    '''
+    LRU of decoded ROMs, a ROM loaded twice (by any path) gets the same id
+    '''
+    def __init__(self, capacity:int=MAX_ROMS):
+        self.capacity = capacity
+        self.roms = OrderedDict()
+        self.ids = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def load(self, path:str) -> int:
+        with open(path, "rb") as f:
+            data = f.read()
+        key = cache.rom_key(data)
+
+        with self.lock:
+            rom_id = self.ids.get(key)
+            if rom_id is not None:
+                self.roms.move_to_end(rom_id)
+                return rom_id
+
+        # Decode outside the lock, other clients keep being served meanwhile
+        rom = Rom(data)
+        with self.lock:
+            # Another client may have loaded the same ROM while we were decoding
+            rom_id = self.ids.get(key)
+            if rom_id is not None:
+                self.roms.move_to_end(rom_id)
+                return rom_id
+
+            rom_id = self.next_id
+            self.next_id += 1
+            rom.key = key
+            self.ids[key] = rom_id
+            self.roms[rom_id] = rom
+            while len(self.roms) > self.capacity:
+                _, evicted = self.roms.popitem(last=False)
+                del self.ids[evicted.key]
+        return rom_id
+
+    def get(self, rom_id:int):
+        with self.lock:
+            rom = self.roms.get(rom_id)
+            if rom is not None:
+                self.roms.move_to_end(rom_id)
+            return rom
+
+class Handler(socketserver.BaseRequestHandler):
+    disassembler = Disassembler()
+
+    def _recv(self, size:int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.request.recv(size - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return bytes(buf)
+
+    def _send(self, status:int, payload:bytes):
+        self.request.sendall(LENGTH.pack(len(payload) + 1) + bytes([status]) + payload)
+
+    def _text(self, rom:Rom, addr:int):
+        tokens, branches = self.disassembler.disasm(rom.data[addr:addr + 2], addr, rom.psets)
+        return "".join(str(token) for token in tokens), branches
+
+    def decode(self, rom:Rom, addrs):
+        out = bytearray()
+        for addr in addrs:
+            # One bad address shouldn't fail the rest of the batch
+            if addr % 2 or addr + 2 > len(rom.data):
+                out.append(ENTRY_BAD_ADDR)
+                continue
+
+            text, branches = self._text(rom, addr)
+            out.append(ENTRY_OK)
+            out += struct.pack("<HB", rom_words(rom.data[addr:addr + 2])[0], len(branches))
+            for branch in branches:
+                out += BRANCH.pack(branch._type, -1 if branch.target is None else branch.target)
+            text = text.encode()
+            out += struct.pack("<H", len(text)) + text
+        return bytes(out)
+
+    def listing(self, rom:Rom, start:int, count:int):
+        lines = []
+        for addr in range(start, min(start + 2 * count, len(rom.data) - 1), 2):
+            text, _ = self._text(rom, addr)
+            lines.append(f"{addr:04x}: {text}")
+        return "\n".join(lines).encode()
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            header = self._recv(LENGTH.size)
+            if header is None:
+                return
+            payload = self._recv(LENGTH.unpack(header)[0])
+            if not payload:
+                return
+
+            op, body = payload[0], payload[1:]
+            try:
+                if op == OP_LOAD:
+                    self._send(STATUS_OK, LENGTH.pack(store.load(body.decode())))
+                    continue
+
+                if op == OP_DECODE:
+                    rom_id, count = DECODE_HEADER.unpack_from(body)
+                    rom = store.get(rom_id)
+                    if rom is None:
+                        self._send(STATUS_UNKNOWN_ROM, b"")
+                        continue
+                    addrs = struct.unpack_from(f"<{count}I", body, DECODE_HEADER.size)
+                    self._send(STATUS_OK, self.decode(rom, addrs))
+                    continue
+
+                if op == OP_LISTING:
+                    rom_id, start, count = LISTING_HEADER.unpack_from(body)
+                    rom = store.get(rom_id)
+                    if rom is None:
+                        self._send(STATUS_UNKNOWN_ROM, b"")
+                        continue
+                    if start % 2:
+                        self._send(STATUS_ERROR, f"Odd start address {start:#x}".encode())
+                        continue
+                    self._send(STATUS_OK, self.listing(rom, start, count))
+                    continue
+
+                self._send(STATUS_ERROR, f"Unknown op {op}".encode())
+            except (OSError, ValueError, struct.error) as e:
+                self._send(STATUS_ERROR, str(e).encode())
+
+def socket_path() -> str:
+    return os.path.join(user_directory(), "e0c6s46.sock")
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    LOAD opens whatever path a client sends and there's no authentication,
+    so the socket is only usable by the user running Binary Ninja
+    '''
+    daemon_threads = True
+
+    def server_bind(self):
+        super().server_bind()
+        # Before listen(), nobody can connect until the mode is restricted
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+def _remove_stale(path:str):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        # Left behind by a server that didn't shut down cleanly
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f"A server is already listening on {path}")
+
+def start(path:str=None, capacity:int=MAX_ROMS):
+    '''
+    Serves decoding on a Unix socket at path (socket_path() by default) from a background thread.
+    Run from Binary Ninja's Python console (or headless) so external tools get the plugin's decoder.
+    The socket is created with mode 0600, clients can read any file the server can
+
+    Returns the server, call shutdown() then server_close() on it to stop
+    '''
+    path = path or socket_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _remove_stale(path)
+
+    server = UnixServer(path, Handler)
+    server.store = RomStore(capacity)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Client:
+    '''
+    Minimal client for the protocol above
+    '''
+    def __init__(self, path:str=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or socket_path())
+
+    def close(self):
+        self.sock.close()
+
+    def _call(self, payload:bytes) -> bytes:
+        self.sock.sendall(LENGTH.pack(len(payload)) + payload)
+        size = LENGTH.unpack(self._recv(LENGTH.size))[0]
+        response = self._recv(size)
+        if response[0] != STATUS_OK:
+            raise ValueError(f"Server error {response[0]}: {response[1:].decode()}")
+        return response[1:]
+
+    def _recv(self, size:int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            buf += chunk
+        return bytes(buf)
+
+    def load(self, path:str) -> int:
+        return LENGTH.unpack(self._call(bytes([OP_LOAD]) + path.encode()))[0]
+
+    def decode(self, rom_id:int, addrs):
+        '''
+        Returns (word, [(BranchType, target or None)], text) per address,
+        None for addresses that are odd or past the end of the ROM
+        '''
+        addrs = list(addrs)
+        body = DECODE_HEADER.pack(rom_id, len(addrs)) + struct.pack(f"<{len(addrs)}I", *addrs)
+        raw = self._call(bytes([OP_DECODE]) + body)
+
+        out = []
+        offset = 0
+        for _ in addrs:
+            status = raw[offset]
+            offset += 1
+            if status != ENTRY_OK:
+                out.append(None)
+                continue
+
+            word, count = struct.unpack_from("<HB", raw, offset)
+            offset += 3
+            branches = []
+            for _ in range(count):
+                _type, target = BRANCH.unpack_from(raw, offset)
+                offset += BRANCH.size
+                branches.append((_type, None if target < 0 else target))
+            size, = struct.unpack_from("<H", raw, offset)
+            offset += 2
+            out.append((word, branches, raw[offset:offset + size].decode()))
+            offset += size
+        return out
+
+    def listing(self, rom_id:int, start:int, count:int) -> str:
+        return self._call(bytes([OP_LISTING]) + LISTING_HEADER.pack(rom_id, start, count)).decode()
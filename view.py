@@ -1,12 +1,119 @@
+from array import array
+
 from binaryninja import (
     Architecture,
     BinaryView,
     Endianness,
     SegmentFlag,
-    BinaryReader
+    SectionSemantics,
+    AnalysisCompletionEvent,
+    BackgroundTaskThread
 )
 
-from .disassembler import Instruction, psets
+from . import cache
+from .fingerprint import FunctionIndex
+from .jumptable import jump_tables
+from .index import InstructionIndex, BankedInstructionIndex
+from .disassembler import Instruction, PSetFinder, psets, rom_words, BANK_SIZE
+from .regions import classify, clip, sweep_psets, Region, CODE
+
+class PSetScan:
+    '''
+    Answers PSET lookups in one bank that its discovery hasn't reached yet.
+
+    Scans back from the address to the closest PSET and remembers the answer for every word
+    it passed, so each word of the bank is scanned at most once and repeat lookups (info
+    then text for the same branch) are a single array read. Instructions are shared.
+    Filler runs and tables never hold PSET words, so this agrees with the sweep exactly
+    and nothing found this way has to be reanalysed later
+    '''
+    UNKNOWN = -2
+    NONE = -1
+
+    def __init__(self, rom:bytes, start:int, end:int):
+        self.rom = rom
+        self.start = start
+        # Per word of the bank: address of the last PSET at or before it, NONE or UNKNOWN
+        self.last = array("i", [self.UNKNOWN]) * ((end - start) // 2)
+        self.instrs = {}
+
+    def _scan(self, i:int) -> int:
+        rom, last = self.rom, self.last
+        found = self.NONE
+        j = i
+        while j >= 0:
+            if last[j] != self.UNKNOWN:
+                found = last[j]
+                break
+            a = self.start + 2 * j
+            # 1110 010p pppp
+            if ((rom[a] & 15) << 8 | rom[a + 1]) & 0xFE0 == 0xE40:
+                found = a
+                self.instrs[a] = Instruction(rom[a:a + 2], a)
+                break
+            j -= 1
+
+        for k in range(max(j, 0), i + 1):
+            last[k] = found
+        return found
+
+    def __call__(self, addr:int, frontier:int):
+        '''
+        Last PSET in [frontier, addr] or None, the frontier never drops below the start of the bank
+        '''
+        if not self.last:
+            return None
+        i = min((addr - self.start) // 2, len(self.last) - 1)
+        found = self.last[i]
+        if found == self.UNKNOWN:
+            found = self._scan(i)
+        if found < frontier:
+            return None
+        return self.instrs[found]
+
+class PSetDiscovery(BackgroundTaskThread):
+    '''
+    Sweeps one bank for PSETs off the UI thread, publishing what it finds batch by batch
+    '''
+    # Words swept between progress updates
+    BATCH = 0x100
+
+    def __init__(self, view, finder:PSetFinder, number:int, key:str):
+        BackgroundTaskThread.__init__(self, f"E0C6S46: Finding PSETs in bank {number}", True)
+        self.view = view
+        self.finder = finder
+        self.number = number
+        self.key = key
+
+    def run(self):
+        found = []
+        start, end = self.view.bank_range(self.number)
+        for region in clip(self.view.regions, start // 2, end // 2):
+            first = region.start
+            while first < region.end:
+                # Cancelling only stops the progressive publishing, the rest of the bank is swept
+                # in one go so it isn't left on on-demand lookups for the rest of the session
+                if self.cancelled:
+                    self.progress = f"E0C6S46: Finishing PSET discovery in bank {self.number}"
+                    last = region.end
+                else:
+                    last = min(first + self.BATCH, region.end)
+
+                batch = []
+                if region.kind == CODE:
+                    batch = sweep_psets(self.view.rom, [Region(CODE, first, last)])
+                found.extend(batch)
+
+                self.finder.update(
+                    ((addr, Instruction(word.to_bytes(2, "big"), addr)) for addr, word in batch),
+                    frontier=2 * last
+                )
+                if not self.cancelled:
+                    self.progress = f"E0C6S46: Finding PSETs in bank {self.number} {100 * (2 * last - start) // (end - start)}%"
+                first = last
+
+        cache.store(self.key, found)
+        self.finder.finish_discovery()
 
 class View(BinaryView):
     name = "E0C6S46"
@@ -29,31 +136,112 @@ class View(BinaryView):
     def perform_get_address_size(self):
         return 2
 
-    def find_psets(self):
-        br = BinaryReader(self, Endianness.BigEndian)
-        addr = 0
-        instr_data = br.read(2)
+    def bank_range(self, number:int):
+        start = number * BANK_SIZE
+        return start, min(start + BANK_SIZE, len(self.rom))
+
+    def load_bank_psets(self, number:int, finder:PSetFinder):
+        '''
+        Called the first time anything in a bank needs a PSET
+        '''
+        start, end = self.bank_range(number)
+        if start >= end:
+            return
 
-        while(instr_data is not None):
-            instr = Instruction(instr_data, addr)
-            if instr.mnemonic == "PSET":
-                # log.log_info(f"{hex(instr.addr)}: {instr.mnemonic}")
-                psets.add(instr.addr, instr)
-            addr += 2
-            instr_data = br.read(2)
+        # Reopening a ROM we've already swept loads the bank's PSET index from disk
+        key = cache.bank_key(self.rom[start:end], number)
+        found = cache.load(key)
+        if found is not None:
+            finder.update((addr, Instruction(word.to_bytes(2, "big"), addr)) for addr, word in found)
+            return
+
+        # Otherwise sweep in the background so the listing shows up straight away
+        finder.begin_discovery(PSetScan(self.rom, start, end), frontier=start)
+        task = PSetDiscovery(self, finder, number, key)
+        self.pset_discovery.append(task)
+        task.start()
+
+    def add_region_sections(self, rom:bytes):
+        # Filler and tables get data semantics so linear sweep doesn't make functions out of them
+        self.regions = classify(rom_words(rom))
+        for region in self.regions:
+            semantics = SectionSemantics.ReadOnlyCodeSectionSemantics
+            if region.kind != CODE:
+                semantics = SectionSemantics.ReadOnlyDataSectionSemantics
+
+            self.add_auto_section(f"{region.kind}_{2 * region.start:04x}",
+                2 * region.start, 2 * len(region), semantics)
 
     def init(self):
         self.platform = Architecture["E0C6S46"].standalone_platform
         self.arch = Architecture["E0C6S46"]
         
-        self.add_auto_segment(0, 0x3000, 0, 0x3000,
-            SegmentFlag.SegmentReadable |
-            SegmentFlag.SegmentContainsCode | 
-            SegmentFlag.SegmentExecutable
-        )
+        self.rom = self.raw.read(0, len(self.raw))
+
+        # One segment per bank, sized from the file
+        for number in range((len(self.rom) + BANK_SIZE - 1) // BANK_SIZE):
+            start, end = self.bank_range(number)
+            self.add_auto_segment(start, end - start, start, end - start,
+                SegmentFlag.SegmentReadable |
+                SegmentFlag.SegmentContainsCode | 
+                SegmentFlag.SegmentExecutable
+            )
 
         self.add_entry_point(0x100 * 2)
 
-        self.find_psets()
+        self.add_region_sections(self.rom)
+
+        # Each bank's PSETs are found the first time something in it is decoded
+        self.pset_discovery = []
+        self.psets = psets.open(cache.rom_key(self.rom), self.load_bank_psets)
+
+        # JPBA site -> targets handed to analysis
+        self.jump_table_targets = {}
+        # Starts of functions already checked against the fingerprint index
+        self.fingerprinted = set()
+        self.fingerprint_index = None
+        self.completion_events = [AnalysisCompletionEvent(self, self.on_analysis_complete)]
+
+        return True
+
+    def on_analysis_complete(self, _event=None):
+        changed = self.apply_jump_tables()
+        found = self.apply_fingerprints()
+        # New jump targets uncover new code, which can hold more JPBAs and more
+        # functions to name, so go again until analysis stops turning things up
+        if changed or found:
+            self.completion_events.append(AnalysisCompletionEvent(self, self.on_analysis_complete))
+
+    def apply_jump_tables(self) -> int:
+        return jump_tables.apply(self, self.jump_table_targets)
+
+    def apply_fingerprints(self) -> int:
+        '''
+        Names functions we've seen in other ROMs, only looking at functions that are new
+        since the last pass. Returns how many new functions there were
+        '''
+        new = [func for func in self.functions if func.start not in self.fingerprinted]
+        self.fingerprinted.update(func.start for func in new)
+        if not new:
+            return 0
+
+        if self.fingerprint_index is None:
+            self.fingerprint_index = FunctionIndex.load()
+        if len(self.fingerprint_index):
+            self.fingerprint_index.label_view(self, new)
+        return len(new)
+
+    def load_bank_index(self, number:int) -> InstructionIndex:
+        # Built once per bank, then kept in the database with the rest of the analysis
+        index = InstructionIndex.load(self, number)
+        if index is None:
+            start, end = self.bank_range(number)
+            index = InstructionIndex.build(self.rom[start:end], base=start, pset_finder=self.psets)
+            index.store(self, number)
+        return index
 
-        return True
\ No newline at end of file
+    def instruction_index(self) -> BankedInstructionIndex:
+        if getattr(self, "_instruction_index", None) is None:
+            banks = (len(self.rom) + BANK_SIZE - 1) // BANK_SIZE
+            self._instruction_index = BankedInstructionIndex(self.load_bank_index, banks)
+        return self._instruction_index
\ No newline at end of file